@@ -1,127 +1,225 @@
 #!/usr/bin/env python3
 
+import fcntl
 import os
-import requests
-import json
 import hashlib
+import random
+import time
 from datetime import datetime
 from pathlib import Path
+from types import MappingProxyType
 
 # Configuration
 WEBHOOK_URL = "<webhook_url>"
-STATE_FILE = "/tmp/checkmk_discord_state.log"
+ICON_URL = "https://checkmk.com/favicon.ico"
+DEDUP_DIR = Path("/tmp/ckmk_dedup")
+DEDUP_LOCK = DEDUP_DIR / ".lock"  # Serializes replacing expired markers
 DEDUP_WINDOW = 300  # 5-minute deduplication window
+TIMEOUT = (2, 8)  # Connect and read timeouts in seconds
+
+# Shared HTTP session, created on first send (see get_session)
+SESSION = None
+
+# Discord markdown characters and their escaped forms
+_ESCAPE = str.maketrans({'_': r'\_', '*': r'\*', '~': r'\~'})
+
+# State-specific messages with your exact wording (read-only)
+_MESSAGES = {
+    "OK": MappingProxyType({
+        "color": 65280,       # Green
+        "emoji": "✅",
+        "title": "[AWS] Service Recovery",
+        "description": "The Windows server services are recovered.",
+        "details": "Every services are working correctly.",
+        "footer": "System back to normal operation"
+    }),
+    "WARNING": MappingProxyType({
+        "color": 16776960,    # Yellow
+        "emoji": "⚠️",
+        "title": "[AWS] Performance Warning",
+        "description": "The Windows server services could be slower.",
+        "details": "You could have network failure and file access deprecated.",
+        "footer": "Investigate when possible"
+    }),
+    "CRITICAL": MappingProxyType({
+        "color": 16711680,    # Red
+        "emoji": "🚨",
+        "title": "[AWS] Service Outage",
+        "description": "The Windows server services are down.",
+        "details": "The network could not work correctly and your file access aren't sure.",
+        "footer": "Immediate action required"
+    })
+}
 
 def escape_discord(text):
     """Escape special Discord markdown characters"""
-    return text.replace('_', r'\_').replace('*', r'\*').replace('~', r'\~') if text else ""
+    return text.translate(_ESCAPE) if text else ""
 
-def get_alert_fingerprint():
+def get_alert_fingerprint(env):
     """Create unique hash for current alert"""
-    return hashlib.md5(f"{os.environ.get('NOTIFY_HOSTNAME','')}_{os.environ.get('NOTIFY_SERVICEDESC','')}_{os.environ.get('NOTIFY_SERVICESTATE','')}".encode()).hexdigest()
+    h = hashlib.blake2b(digest_size=8)
+    h.update(env.get('NOTIFY_HOSTNAME', '').encode())
+    h.update(b'\x00')
+    h.update(env.get('NOTIFY_SERVICEDESC', '').encode())
+    h.update(b'\x00')
+    h.update(env.get('NOTIFY_SERVICESTATE', '').encode())
+    return h.hexdigest()
 
 def is_duplicate_notification(fingerprint):
-    """Check for recent duplicate alerts"""
+    """Atomically check for and record a recent duplicate alert"""
+    marker = DEDUP_DIR / fingerprint
     try:
-        if not Path(STATE_FILE).exists():
+        fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        os.close(fd)
+        return False
+    except FileExistsError:
+        pass
+
+    # Marker exists: re-check it under the lock so only one run replaces it
+    lock_fd = os.open(DEDUP_LOCK, os.O_CREAT | os.O_WRONLY, 0o600)
+    with os.fdopen(lock_fd, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if time.time() - marker.stat().st_mtime < DEDUP_WINDOW:
+                return True
+            os.unlink(marker)
+        except FileNotFoundError:
+            pass
+
+        # A lock-free fast-path create may still beat us; then we are the duplicate
+        try:
+            fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+            os.close(fd)
             return False
+        except FileExistsError:
+            return True
 
-        with open(STATE_FILE, 'r') as f:
-            for line in f.readlines():
-                stored_fp, timestamp = line.strip().split('|')
-                if stored_fp == fingerprint and (datetime.now() - datetime.fromtimestamp(float(timestamp))).seconds < DEDUP_WINDOW:
-                    return True
-        return False
-    except:
-        return False
+def forget_notification(fingerprint):
+    """Drop the dedup marker so a failed alert can be retried"""
+    try:
+        os.unlink(DEDUP_DIR / fingerprint)
+    except OSError:
+        pass
 
-def record_notification(fingerprint):
-    """Log sent notifications"""
-    with open(STATE_FILE, 'a') as f:
-        f.write(f"{fingerprint}|{datetime.now().timestamp()}\n")
+def sweep_notifications():
+    """Remove long-expired dedup markers to bound the directory size"""
+    cutoff = time.time() - DEDUP_WINDOW * 10
+    try:
+        lock_fd = os.open(DEDUP_LOCK, os.O_CREAT | os.O_WRONLY, 0o600)
+        with os.fdopen(lock_fd, "w") as lock, os.scandir(DEDUP_DIR) as entries:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.unlink(entry.path)
+                except OSError:
+                    pass
+    except OSError:
+        # Housekeeping only: never fail a notification over it
+        pass
+
+def get_session():
+    """Return the shared HTTP session, importing requests on first use"""
+    global SESSION
+    if SESSION is None:
+        import requests
+        SESSION = requests.Session()
+        SESSION.headers.update({"Content-Type": "application/json"})
+    return SESSION
+
+def encode_payload(payload):
+    """Encode a JSON payload with orjson, falling back to the standard library"""
+    try:
+        from orjson import dumps
+    except ImportError:
+        import json
+        return json.dumps(payload).encode()
+    return dumps(payload)
+
+def build_embed_template(msg):
+    """Build the static part of a Discord embed; the title takes {host}"""
+    return {
+        "title": f"{msg['emoji']} {msg['title']} - {{host}} {msg['emoji']}",
+        "color": msg["color"],
+        "description": msg["description"],
+        "fields": [{"name": "📢 Status Update", "value": msg["details"]}],
+        "footer": {"text": msg["footer"], "icon_url": ICON_URL}
+    }
 
-def get_custom_message(state):
+def get_custom_message(state, env):
     """Return state-specific messages with your exact wording"""
+    msg = _MESSAGES.get(state)
+    if msg is not None:
+        return msg
     return {
-        "OK": {
-            "color": 65280,       # Green
-            "emoji": "✅",
-            "title": "[AWS] Service Recovery",
-            "description": "The Windows server services are recovered.",
-            "details": "Every services are working correctly.",
-            "footer": "System back to normal operation"
-        },
-        "WARNING": {
-            "color": 16776960,    # Yellow
-            "emoji": "⚠️",
-            "title": "[AWS] Performance Warning",
-            "description": "The Windows server services could be slower.",
-            "details": "You could have network failure and file access deprecated.",
-            "footer": "Investigate when possible"
-        },
-        "CRITICAL": {
-            "color": 16711680,    # Red
-            "emoji": "🚨",
-            "title": "[AWS] Service Outage",
-            "description": "The Windows server services are down.",
-            "details": "The network could not work correctly and your file access aren't sure.",
-            "footer": "Immediate action required"
-        }
-    }.get(state, {
         "color": 3553599,        # Gray (default)
         "emoji": "ℹ️",
         "title": "Service Notification",
         "description": f"Service state changed to {state}",
-        "details": os.environ.get('NOTIFY_SERVICEOUTPUT', 'No details available'),
+        "details": env.get('NOTIFY_SERVICEOUTPUT', 'No details available'),
         "footer": "CheckMK Monitoring"
-    })
-
-try:
-    # Deduplication check
-    alert_id = get_alert_fingerprint()
-    if is_duplicate_notification(alert_id):
-        exit(0)
+    }
 
-    # Get environment variables
-    host = escape_discord(os.environ.get('NOTIFY_HOSTNAME', 'Unknown Server'))
-    service = escape_discord(os.environ.get('NOTIFY_SERVICEDESC', 'Windows Services'))
-    state = os.environ.get('NOTIFY_SERVICESTATE', 'UNKNOWN')
+# Embed templates for the known states, built once at module load
+_EMBED_TEMPLATES = {state: build_embed_template(msg) for state, msg in _MESSAGES.items()}
 
-    # Get custom message configuration
-    msg = get_custom_message(state)
+def main():
+    """Send the current CheckMK notification to Discord"""
+    env = os.environ.copy()
 
-    # Prepare Discord embed
-    embed = {
-        "title": f"{msg['emoji']} {msg['title']} - {host} {msg['emoji']}",
-        "color": msg["color"],
-        "description": msg["description"],
-        "fields": [
-            {"name": "🖥️ Server", "value": host, "inline": True},
-            {"name": "🔧 Service", "value": service, "inline": True},
-            {"name": "📢 Status Update", "value": msg["details"]}
-        ],
-        "footer": {
-            "text": msg["footer"],
-            "icon_url": "https://checkmk.com/favicon.ico"
-        },
-        "timestamp": os.environ.get('NOTIFY_SHORTDATETIME', '')
-    }
+    try:
+        # Deduplication check (records the alert before it is sent)
+        DEDUP_DIR.mkdir(exist_ok=True)
+        alert_id = get_alert_fingerprint(env)
+        if is_duplicate_notification(alert_id):
+            return
+
+        # Get environment variables
+        host = escape_discord(env.get('NOTIFY_HOSTNAME', 'Unknown Server'))
+        service = escape_discord(env.get('NOTIFY_SERVICEDESC', 'Windows Services'))
+        state = env.get('NOTIFY_SERVICESTATE', 'UNKNOWN')
+
+        # Get embed template for the state
+        template = _EMBED_TEMPLATES.get(state)
+        if template is None:
+            template = build_embed_template(get_custom_message(state, env))
+
+        # Prepare Discord embed
+        embed = {
+            **template,
+            "title": template["title"].format(host=host),
+            "fields": [
+                {"name": "🖥️ Server", "value": host, "inline": True},
+                {"name": "🔧 Service", "value": service, "inline": True},
+                *template["fields"]
+            ],
+            "timestamp": env.get('NOTIFY_SHORTDATETIME', '')
+        }
 
-    # Send to Discord
-    response = requests.post(
-        WEBHOOK_URL,
-        json={"embeds": [embed]},
-        headers={"Content-Type": "application/json"},
-        timeout=10
-    )
-    response.raise_for_status()
-
-    # Record successful notification
-    record_notification(alert_id)
-
-except Exception as e:
-    with open("/tmp/checkmk_discord_errors.log", "a") as f:
-        f.write(f"{datetime.now()} - Error: {str(e)}\n")
-    raise
+        # Send to Discord
+        try:
+            response = get_session().post(
+                WEBHOOK_URL,
+                data=encode_payload({"embeds": [embed]}),
+                timeout=TIMEOUT
+            )
+            response.raise_for_status()
+        except Exception:
+            forget_notification(alert_id)
+            raise
+
+        # Occasionally drop long-expired markers, once the alert is out
+        if random.random() < 0.01:
+            sweep_notifications()
+
+    except Exception as e:
+        with open("/tmp/checkmk_discord_errors.log", "a") as f:
+            f.write(f"{datetime.now()} - Error: {str(e)}\n")
+        raise
+
+if __name__ == "__main__":
+    main()
 
 # This script has been generated by DeepSeek. 
\ No newline at end of file
@@ -1,44 +1,159 @@
 #!/usr/bin/env python3
 
+import fcntl
+import hashlib
 import os
 import requests
 import json
+import sqlite3
+import tempfile
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
 
+# Prefer orjson for payload encoding, fall back to the standard library
+try:
+    from orjson import dumps
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj).encode()
+
 # Configuration
 GLPI_API_URL = "<apirest_url>"
 APP_TOKEN = "<app_token>"
 USER_TOKEN = "<user_token>"
-STATE_FILE = "/tmp/glpi_ticket_state.json"
+STATE_FILE = "/tmp/glpi_ticket_state.db"
+LEGACY_STATE_FILE = "/tmp/glpi_ticket_state.json"  # Imported once when STATE_FILE is created
+LOCK_DIR = "/tmp/glpi_ticket_locks"
+TOKEN_FILE = "/tmp/glpi_session.token"
+TOKEN_TTL = 3000  # Reuse a cached session token for up to 50 minutes
+TIMEOUT = (2, 8)  # Connect and read timeouts in seconds
+
+# Shared HTTP session: reuses one keep-alive connection for every API call
+SESSION = requests.Session()
+SESSION.mount(GLPI_API_URL, HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=4,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+SESSION.headers.update({"App-Token": APP_TOKEN, "Content-Type": "application/json"})
+
+# Util: Open ticket state database (autocommit, WAL for concurrent runs)
+def open_state():
+    conn = sqlite3.connect(STATE_FILE, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Create the table and import legacy state in one write transaction,
+    # so concurrent first runs import at most once
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tickets'"
+        ).fetchone()
+        if not exists:
+            conn.execute("CREATE TABLE tickets(fp TEXT PRIMARY KEY, tid INTEGER)")
+            import_legacy_state(conn)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return conn
+
+# Util: Import open tickets from the old JSON state file, if any
+def import_legacy_state(conn):
+    try:
+        with open(LEGACY_STATE_FILE, "r") as f:
+            legacy_state = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"Could not import {LEGACY_STATE_FILE}: {e}")
+        return
+    for fingerprint, ticket_id in legacy_state.items():
+        conn.execute("INSERT OR IGNORE INTO tickets VALUES (?, ?)", (fingerprint, ticket_id))
+    print(f"Imported {len(legacy_state)} open tickets from {LEGACY_STATE_FILE}")
+
+# Util: Look up open ticket for a fingerprint
+def get_ticket(conn, fingerprint):
+    row = conn.execute("SELECT tid FROM tickets WHERE fp = ?", (fingerprint,)).fetchone()
+    return row[0] if row else None
+
+# Util: Save open ticket for a fingerprint (caller holds its fingerprint_lock)
+def save_ticket(conn, fingerprint, ticket_id):
+    conn.execute("INSERT INTO tickets VALUES (?, ?)", (fingerprint, ticket_id))
 
-# Util: Read existing state (open tickets)
-def read_state():
-    if Path(STATE_FILE).exists():
-        with open(STATE_FILE, "r") as f:
-            return json.load(f)
-    return {}
+# Util: Forget ticket for a fingerprint
+def delete_ticket(conn, fingerprint):
+    conn.execute("DELETE FROM tickets WHERE fp = ?", (fingerprint,))
 
-# Util: Save ticket state
-def write_state(state):
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f)
+# Util: Serialize lookup + create/close for one fingerprint across concurrent runs
+@contextmanager
+def fingerprint_lock(fingerprint):
+    os.makedirs(LOCK_DIR, exist_ok=True)
+    name = hashlib.blake2b(fingerprint.encode(), digest_size=8).hexdigest()
+    fd = os.open(os.path.join(LOCK_DIR, f"{name}.lock"), os.O_CREAT | os.O_WRONLY, 0o600)
+    with os.fdopen(fd, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
 
 # Open GLPI API session
 def open_session():
-    res = requests.get(
+    res = SESSION.get(
         f"{GLPI_API_URL}/initSession",
-        headers={"Authorization": f"user_token {USER_TOKEN}", "App-Token": APP_TOKEN}
+        headers={"Authorization": f"user_token {USER_TOKEN}"},
+        timeout=TIMEOUT
     )
     res.raise_for_status()
     return res.json()["session_token"]
 
-# Kill GLPI session
-def close_session(session_token):
-    requests.get(
-        f"{GLPI_API_URL}/killSession",
-        headers={"App-Token": APP_TOKEN, "Session-Token": session_token}
-    )
+# Util: Read the cached session token, or None if missing, empty or expired
+def read_cached_token():
+    try:
+        with open(TOKEN_FILE) as f:
+            mtime = os.fstat(f.fileno()).st_mtime
+            session_token = f.read()
+    except FileNotFoundError:
+        return None
+    if session_token and time.time() - mtime < TOKEN_TTL:
+        return session_token
+    return None
+
+# Get a session token, reusing the cached one unless it is missing or rejected
+def get_session_token(rejected=None):
+    session_token = read_cached_token()
+    if session_token and session_token != rejected:
+        return session_token
+
+    # Serialize refreshes so concurrent runs share one new GLPI session
+    lock_fd = os.open(f"{TOKEN_FILE}.lock", os.O_CREAT | os.O_WRONLY, 0o600)
+    with os.fdopen(lock_fd, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        session_token = read_cached_token()
+        if session_token and session_token != rejected:
+            return session_token
+
+        session_token = open_session()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(TOKEN_FILE))  # O_EXCL, mode 0600
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(session_token)
+            os.replace(tmp_path, TOKEN_FILE)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return session_token
+
+# Run an API call with the cached session, re-opening it once if GLPI rejects it
+def with_session(call, *args):
+    session_token = get_session_token()
+    try:
+        return call(session_token, *args)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 401:
+            raise
+        return call(get_session_token(rejected=session_token), *args)
 
 # Create new ticket with ITIL category set to "CPU Overload" (ID 698)
 def create_ticket(session_token, host, service, state, output):
@@ -55,15 +170,11 @@ def create_ticket(session_token, host, service, state, output):
             "itilcategories_id": 698  # CPU Overload category
         }
     }
-    res = requests.post(
+    res = SESSION.post(
         f"{GLPI_API_URL}/Ticket",
-        headers={
-            "Content-Type": "application/json",
-            "App-Token": APP_TOKEN,
-            "Session-Token": session_token
-        },
-        json=payload,
-        timeout=10
+        headers={"Session-Token": session_token},
+        data=dumps(payload),
+        timeout=TIMEOUT
     )
     res.raise_for_status()
     return res.json()["id"]
@@ -76,15 +187,11 @@ def close_ticket(session_token, ticket_id):
             "status": 6  # Solved
         }
     }
-    res = requests.put(
+    res = SESSION.put(
         f"{GLPI_API_URL}/Ticket/{ticket_id}",
-        headers={
-            "Content-Type": "application/json",
-            "App-Token": APP_TOKEN,
-            "Session-Token": session_token
-        },
-        json=payload,
-        timeout=10
+        headers={"Session-Token": session_token},
+        data=dumps(payload),
+        timeout=TIMEOUT
     )
     res.raise_for_status()
 
@@ -96,25 +203,23 @@ def main():
     output = os.environ.get("NOTIFY_SERVICEOUTPUT", "No output")
 
     fingerprint = f"{host}_{service}"
-    state_data = read_state()
-
-    session = open_session()
+    state_db = open_state()
 
     try:
-        if state in ["CRITICAL", "WARNING"]:
-            if fingerprint not in state_data:
-                ticket_id = create_ticket(session, host, service, state, output)
-                state_data[fingerprint] = ticket_id
-                print(f"Created ticket {ticket_id} for {fingerprint}")
-        elif state == "OK":
-            if fingerprint in state_data:
-                ticket_id = state_data[fingerprint]
-                close_ticket(session, ticket_id)
-                print(f"Closed ticket {ticket_id} for {fingerprint}")
-                del state_data[fingerprint]
+        with fingerprint_lock(fingerprint):
+            if state in ["CRITICAL", "WARNING"]:
+                if get_ticket(state_db, fingerprint) is None:
+                    ticket_id = with_session(create_ticket, host, service, state, output)
+                    save_ticket(state_db, fingerprint, ticket_id)
+                    print(f"Created ticket {ticket_id} for {fingerprint}")
+            elif state == "OK":
+                ticket_id = get_ticket(state_db, fingerprint)
+                if ticket_id is not None:
+                    with_session(close_ticket, ticket_id)
+                    print(f"Closed ticket {ticket_id} for {fingerprint}")
+                    delete_ticket(state_db, fingerprint)
     finally:
-        close_session(session)
-        write_state(state_data)
+        state_db.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file